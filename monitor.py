@@ -1,21 +1,28 @@
 import os
-import json
 import re
+import atexit
+import shutil
+import orjson
 import requests
 import smtplib
-import time
 from email.mime.text import MIMEText
 from datetime import datetime, timedelta, timezone 
 from typing import Dict, List, Optional
-from collections import defaultdict
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from operator import itemgetter
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # ==========================================
 # ⚙️ CONFIGURATION & CONSTANTS
 # ==========================================
 TARGET_URL = "https://www.anp.org.ma/_vti_bin/WS/Service.svc/mvmnv/all"
 STATE_FILE = "state.json" 
-HISTORY_FILE = "history.json"
+HISTORY_FILE = "history.jsonl"  # Append-only archive, one completed port call per line
 STATE_ENV_VAR = "VESSEL_STATE_DATA" 
+HISTORY_LIMIT = 1000  # Completed port calls kept in state.json between monthly reports
 
 EMAIL_USER = os.getenv("EMAIL_USER")
 EMAIL_PASS = os.getenv("EMAIL_PASS")
@@ -28,13 +35,17 @@ EMAIL_ENABLED = str(os.getenv("EMAIL_ENABLED", "true")).lower() == "true"
 RUN_MODE = os.getenv("RUN_MODE", "monitor") 
 
 # Target Ports: Safi (03), Nador (06), Jorf Lasfar (07)
-ALLOWED_PORTS = {"03", "06", "07"} 
+ALLOWED_PORTS = frozenset({"03", "06", "07"})
+_PORT_NAMES = {"03": "Safi", "06": "Nador", "07": "Jorf Lasfar"}
 
 # Status categories for tracking
-ANCHORAGE_STATUSES = {"EN RADE"}
-BERTH_STATUSES = {"A QUAI"}
-COMPLETED_STATUSES = {"APPAREILLAGE", "TERMINE"}
-PLANNED_STATUSES = {"PREVU"}
+ANCHORAGE_STATUSES = frozenset({"EN RADE"})
+BERTH_STATUSES = frozenset({"A QUAI"})
+COMPLETED_STATUSES = frozenset({"APPAREILLAGE", "TERMINE"})
+PLANNED_STATUSES = frozenset({"PREVU"})
+EXPECTED_STATUSES = ANCHORAGE_STATUSES | BERTH_STATUSES | COMPLETED_STATUSES | PLANNED_STATUSES
+# Timer field credited with the time a vessel spends in each status
+_STATUS_BUCKET = {**{s: "anchorage_hours" for s in ANCHORAGE_STATUSES}, **{s: "berth_hours" for s in BERTH_STATUSES}}
 
 # ==========================================
 # 🚦 STATUS CLEANING (FIXED LOGIC)
@@ -46,8 +57,7 @@ def clean_status(raw_status: str) -> str:
     
     status = raw_status.strip().upper()
     
-    expected_statuses = {"PREVU", "EN RADE", "A QUAI", "APPAREILLAGE", "TERMINE"}
-    if status not in expected_statuses:
+    if status not in EXPECTED_STATUSES:
         print(f"[WARNING] Unexpected API Status: '{raw_status}'")
     
     return status
@@ -55,46 +65,63 @@ def clean_status(raw_status: str) -> str:
 # ==========================================
 # 🌐 NETWORK RESILIENCE (BATTLE READY HEADERS)
 # ==========================================
-def fetch_vessel_data_with_retry(max_retries=3, initial_delay=5):
-    """Fetch vessel data with full browser spoofing to bypass WAFs"""
-    for attempt in range(max_retries):
-        try:
-            print(f"[INFO] Fetching vessel data (attempt {attempt + 1}/{max_retries})")
-            
-            # Upgraded headers to mimic a real browser session
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                'Accept': 'application/json, text/plain, */*',
-                'Accept-Language': 'fr-FR,fr;q=0.9,en-US;q=0.8,en;q=0.7',
-                'Accept-Encoding': 'gzip, deflate, br',
-                'Referer': 'https://www.anp.org.ma/',
-                'Origin': 'https://www.anp.org.ma',
-                'Connection': 'keep-alive',
-                'Sec-Fetch-Dest': 'empty',
-                'Sec-Fetch-Mode': 'cors',
-                'Sec-Fetch-Site': 'same-origin',
-                'Pragma': 'no-cache',
-                'Cache-Control': 'no-cache'
-            }
-            
-            resp = requests.get(TARGET_URL, timeout=(10, 60), headers=headers)
-            resp.raise_for_status()
-            
-            data = resp.json()
-            if not isinstance(data, list):
-                raise ValueError("API response is not a list")
-                
-            print(f"[SUCCESS] Fetched {len(data)} vessel records")
-            return data
-            
-        except (requests.exceptions.RequestException, ValueError) as e:
-            print(f"[WARNING] Attempt {attempt + 1} failed: {e}")
-            if attempt < max_retries - 1:
-                time.sleep(initial_delay * (2 ** attempt))
-            else:
-                raise
+# Upgraded headers to mimic a real browser session
+BROWSER_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': 'application/json, text/plain, */*',
+    'Accept-Language': 'fr-FR,fr;q=0.9,en-US;q=0.8,en;q=0.7',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'Referer': 'https://www.anp.org.ma/',
+    'Origin': 'https://www.anp.org.ma',
+    'Connection': 'keep-alive',
+    'Sec-Fetch-Dest': 'empty',
+    'Sec-Fetch-Mode': 'cors',
+    'Sec-Fetch-Site': 'same-origin',
+    'Pragma': 'no-cache',
+    'Cache-Control': 'no-cache'
+}
+
+# Shared session: keeps the TLS connection (and WAF cookies) alive across calls
+SESSION = requests.Session()
+SESSION.headers.update(BROWSER_HEADERS)
+# Transient failures are retried by urllib3 on the warm connection, with backoff
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4, pool_maxsize=8,
+    max_retries=Retry(total=3, backoff_factor=5, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset(["GET"]))
+))
+atexit.register(SESSION.close)
+
+def fetch_vessel_data_with_retry(state: Dict) -> Optional[List]:
+    """Fetch vessel data with full browser spoofing to bypass WAFs.
+
+    Retries and backoff are handled by the session's HTTPAdapter. Sends the
+    ETag/Last-Modified validators kept in state as a conditional GET and
+    returns None when the API answers 304 Not Modified.
+    """
+    conditional = {"If-None-Match": state.get("_etag"), "If-Modified-Since": state.get("_last_modified")}
+    conditional = {k: v for k, v in conditional.items() if v}
+    print("[INFO] Fetching vessel data")
+    try:
+        resp = SESSION.get(TARGET_URL, timeout=(10, 60), headers=conditional)
+        resp.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        print(f"[WARNING] Fetch failed after retries: {e}")
+        raise
+    if resp.status_code == 304:
+        print("[INFO] Vessel data unchanged since last fetch (304)")
+        return None
     
-    raise Exception("All retry attempts failed")
+    data = orjson.loads(resp.content)
+    if not isinstance(data, list):
+        raise ValueError("API response is not a list")
+    
+    for key, header in (("_etag", "ETag"), ("_last_modified", "Last-Modified")):
+        if resp.headers.get(header): state[key] = resp.headers[header]
+        else: state.pop(key, None)
+        
+    print(f"[SUCCESS] Fetched {len(data)} vessel records")
+    return data
 
 # ==========================================
 # 💾 STATE MANAGEMENT (STABILITY UPGRADE)
@@ -103,8 +130,8 @@ def load_state() -> Dict:
     """Load state with multi-source validation"""
     if os.path.exists(STATE_FILE):
         try:
-            with open(STATE_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
+            with open(STATE_FILE, "rb") as f:
+                data = orjson.loads(f.read())
                 if isinstance(data, dict) and "active" in data and "history" in data:
                     return data
         except Exception as e:
@@ -113,10 +140,10 @@ def load_state() -> Dict:
     state_data = os.getenv(STATE_ENV_VAR)
     if state_data:
         try:
-            data = json.loads(state_data)
+            data = orjson.loads(state_data)
             if isinstance(data, dict) and "active" in data and "history" in data:
                 return data
-        except Exception:
+        except ValueError:
             pass
     
     return {"active": {}, "history": []}
@@ -124,13 +151,23 @@ def load_state() -> Dict:
 def save_state(state: Dict):
     """Save state with transactional backup logic"""
     try:
-        if os.path.exists(STATE_FILE):
-            import shutil
-            shutil.copy2(STATE_FILE, f"{STATE_FILE}.backup")
-        
+        # Serialize first so a bad payload never truncates the temp file
+        payload = orjson.dumps(state, option=orjson.OPT_NON_STR_KEYS)
         temp_file = f"{STATE_FILE}.tmp"
-        with open(temp_file, "w", encoding="utf-8") as f:
-            json.dump(state, f, indent=2, ensure_ascii=False)
+        with open(temp_file, "wb", buffering=1 << 16) as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        
+        # Hard-link the previous state as the backup instead of copying it;
+        # os.replace below swaps the new file in without touching that inode
+        if os.path.exists(STATE_FILE):
+            backup_file = f"{STATE_FILE}.backup"
+            if os.path.lexists(backup_file): os.remove(backup_file)
+            try:
+                os.link(STATE_FILE, backup_file)
+            except OSError:
+                shutil.copy2(STATE_FILE, backup_file)
         
         os.replace(temp_file, STATE_FILE)
     except Exception as e:
@@ -139,51 +176,67 @@ def save_state(state: Dict):
 # ==========================================
 # 📅 DATE & TIME HELPERS
 # ==========================================
+_LOCAL_TZ = timezone(timedelta(hours=1))  # Morocco (UTC+1)
+_MS_DATE_RE = re.compile(r"/Date\((\d+)([+-]\d{4})?\)/")
+_JOURS = ("lundi", "mardi", "mercredi", "jeudi", "vendredi", "samedi", "dimanche")
+_MOIS = ("janvier", "février", "mars", "avril", "mai", "juin", "juillet", "août", "septembre", "octobre", "novembre", "décembre")
+
+@lru_cache(maxsize=4096)
 def parse_ms_date(date_str: str) -> Optional[datetime]:
     if not date_str: return None
-    m = re.search(r"/Date\((\d+)([+-]\d{4})?\)/", date_str)
+    m = _MS_DATE_RE.search(date_str)
     if m: 
         return datetime.fromtimestamp(int(m.group(1)) / 1000.0, tz=timezone.utc)
     return None
 
+@lru_cache(maxsize=4096)
 def fmt_dt(json_date: str) -> str:
     dt = parse_ms_date(json_date)
     if not dt: return "N/A"
-    dt_m = dt.astimezone(timezone(timedelta(hours=1))) 
-    jours = ["lundi", "mardi", "mercredi", "jeudi", "vendredi", "samedi", "dimanche"]
-    mois = ["janvier", "février", "mars", "avril", "mai", "juin", "juillet", "août", "septembre", "octobre", "novembre", "décembre"]
-    return f"{jours[dt_m.weekday()].capitalize()}, {dt_m.day:02d} {mois[dt_m.month-1]} {dt_m.year}"
+    dt_m = dt.astimezone(_LOCAL_TZ) 
+    return f"{_JOURS[dt_m.weekday()].capitalize()}, {dt_m.day:02d} {_MOIS[dt_m.month-1]} {dt_m.year}"
 
+@lru_cache(maxsize=4096)
 def fmt_time_only(json_date: str) -> str:
     dt = parse_ms_date(json_date)
     if not dt: return "N/A"
-    return dt.astimezone(timezone(timedelta(hours=1))).strftime("%H:%M")
+    return dt.astimezone(_LOCAL_TZ).strftime("%H:%M")
+
+@lru_cache(maxsize=8192)
+def _parse_iso(iso_str: str) -> datetime:
+    # Every vessel touched in a tick shares the same timestamp string
+    return datetime.fromisoformat(iso_str)
 
 def port_name(code: str) -> str:
-    return {"03": "Safi", "06": "Nador", "07": "Jorf Lasfar"}.get(str(code), f"Port {code}")
+    return _PORT_NAMES.get(str(code), f"Port {code}")
 
 # ==========================================
 # 📊 ANALYTICS ENGINE
 # ==========================================
-def update_vessel_timers(active_vessel: Dict, new_status: str, now_utc: datetime) -> Dict:
+def update_vessel_timers(active_vessel: Dict, new_status: str, now_utc: datetime,
+                         now_iso: str, now_ts: int) -> Dict:
+    """Accrue time spent in the previous status, then record the new one.
+
+    now_iso/now_ts are the tick timestamp already formatted by the main loop.
+    """
     current_status = active_vessel.get("current_status", "UNKNOWN")
     last_updated_str = active_vessel.get("last_updated")
     
     if last_updated_str:
         try:
-            last_updated = datetime.fromisoformat(last_updated_str)
+            last_updated = _parse_iso(last_updated_str)
             elapsed_hours = (now_utc - last_updated).total_seconds() / 3600.0
             
-            if current_status in ANCHORAGE_STATUSES:
-                active_vessel["anchorage_hours"] = active_vessel.get("anchorage_hours", 0.0) + elapsed_hours
-            elif current_status in BERTH_STATUSES:
-                active_vessel["berth_hours"] = active_vessel.get("berth_hours", 0.0) + elapsed_hours
-        except Exception:
-            pass 
+            bucket = _STATUS_BUCKET.get(current_status)
+            if bucket:
+                active_vessel[bucket] = active_vessel.get(bucket, 0.0) + elapsed_hours
+        except (ValueError, TypeError):
+            pass # Malformed or naive timestamp: skip this interval
     
     active_vessel["current_status"] = new_status
-    active_vessel["last_updated"] = now_utc.isoformat()
-    active_vessel["last_seen"] = now_utc.isoformat()
+    active_vessel["last_updated"] = now_iso
+    active_vessel["last_seen"] = now_iso
+    active_vessel["last_seen_ts"] = now_ts
     return active_vessel
 
 def calculate_performance_note(avg_anchorage: float, avg_berth: float) -> str:
@@ -195,16 +248,7 @@ def calculate_performance_note(avg_anchorage: float, avg_berth: float) -> str:
 # ==========================================
 # 📧 EMAIL TEMPLATES (PREMIUM UI)
 # ==========================================
-def format_vessel_details_premium(entry: dict) -> str:
-    nom = entry.get("nOM_NAVIREField") or "INCONNU"
-    imo = entry.get("nUMERO_LLOYDField") or "N/A"
-    cons = entry.get("cONSIGNATAIREField") or "N/A"
-    escale = entry.get("nUMERO_ESCALEField") or "N/A"
-    eta_line = f"{fmt_dt(entry.get('dATE_SITUATIONField'))} {fmt_time_only(entry.get('hEURE_SITUATIONField'))}"
-    prov = entry.get("pROVField") or "Inconnue"
-    type_nav = entry.get("tYP_NAVIREField") or "N/A"
-
-    return f"""
+_VESSEL_TEMPLATE = """
     <div style="font-family: Arial, sans-serif; margin: 15px 0; border:1px solid #d0d7e1; border-radius: 8px; overflow: hidden;">
         <div style="background: #0a3d62; color: white; padding: 12px; font-size: 16px;">🚢 <b>{nom}</b></div>
         <table style="width: 100%; border-collapse: collapse; font-size: 14px;">
@@ -217,53 +261,73 @@ def format_vessel_details_premium(entry: dict) -> str:
         </table>
     </div>"""
 
-def send_monthly_report(history: list, specific_port: str):
+_ALERT_INTRO_HTML = "<p>Bonjour,<br>Mouvements prévus :</p>"
+_PORT_INTRO_TMPL = "<p>Bonjour,<br>Mouvements prévus au Port de <b>{p}</b> :</p>"
+_PORT_SECTION_TMPL = '<h3 style="color: #0a3d62; border-bottom: 2px solid #0a3d62;">Port de {p}</h3>'
+
+def format_vessel_details_premium(entry: dict) -> str:
+    get = entry.get
+    return _VESSEL_TEMPLATE.format_map({
+        "nom": get("nOM_NAVIREField") or "INCONNU",
+        "imo": get("nUMERO_LLOYDField") or "N/A",
+        "cons": get("cONSIGNATAIREField") or "N/A",
+        "escale": get("nUMERO_ESCALEField") or "N/A",
+        "eta_line": f"{fmt_dt(get('dATE_SITUATIONField'))} {fmt_time_only(get('hEURE_SITUATIONField'))}",
+        "prov": get("pROVField") or "Inconnue",
+        "type_nav": get("tYP_NAVIREField") or "N/A",
+    })
+
+def send_monthly_report(history: list, specific_port: str, outbox: list):
     if not history: return
 
     # MATH STABILITY: Pre-calculate to avoid f-string crashes
+    # Port totals, per-agent stats and vessel rows are all built in a single pass
     total_calls = len(history)
-    total_anch = sum(h.get('anchorage_hours', 0) for h in history)
-    total_berth = sum(h.get('berth_hours', 0) for h in history)
+    total_anch, total_berth = 0.0, 0.0
+    agent_calls, agent_anch, agent_berth = Counter(), defaultdict(float), defaultdict(float)
+    vessel_rows = []
+    for h in history:
+        anch, berth = h.get('anchorage_hours', 0), h.get('berth_hours', 0)
+        total_anch += anch
+        total_berth += berth
+        agent = h.get('agent', 'Inconnu')
+        agent_calls[agent] += 1
+        agent_anch[agent] += anch
+        agent_berth[agent] += berth
+
+        anch, berth = round(anch, 1), round(berth, 1)
+        vessel_rows.append((h.get('departure', ''), f"""
+        <tr style="border-bottom:1px solid #f0f0f0;">
+            <td style="padding: 8px; font-weight: bold;">{h['vessel']}</td>
+            <td style="padding: 8px;">{h.get('agent', '-')}</td>
+            <td style="padding: 8px; text-align: center;">{anch}h</td>
+            <td style="padding: 8px; text-align: center;">{berth}h</td>
+            <td style="padding: 8px; text-align: center; font-weight: bold;">{round(anch+berth, 1)}h</td>
+        </tr>"""))
+    vessel_rows.sort(key=itemgetter(0), reverse=True)
+    vessel_rows = "".join(row for _, row in vessel_rows)
     
     avg_anch = round(total_anch / total_calls, 1) if total_calls > 0 else 0
     avg_berth = round(total_berth / total_calls, 1) if total_calls > 0 else 0
     avg_total = round(avg_anch + avg_berth, 1)
 
-    agent_stats = defaultdict(lambda: {"calls": 0, "total_anch": 0.0, "total_berth": 0.0})
-    for h in history:
-        agent = h.get('agent', 'Inconnu')
-        agent_stats[agent]["calls"] += 1
-        agent_stats[agent]["total_anch"] += h.get('anchorage_hours', 0)
-        agent_stats[agent]["total_berth"] += h.get('berth_hours', 0)
-
-    agent_rows = ""
-    for agent, data in sorted(agent_stats.items(), key=lambda x: x[1]['calls'], reverse=True):
-        a_anch = round(data['total_anch'] / data['calls'], 1) if data['calls'] > 0 else 0
-        a_berth = round(data['total_berth'] / data['calls'], 1) if data['calls'] > 0 else 0
+    agent_rows_parts = []
+    for agent, calls in agent_calls.most_common():
+        a_anch = round(agent_anch[agent] / calls, 1)
+        a_berth = round(agent_berth[agent] / calls, 1)
         note = calculate_performance_note(a_anch, a_berth)
         a_color = "#e74c3c" if a_anch > 12 else "#27ae60"
         b_color = "#f39c12" if a_berth > 36 else "#27ae60"
         
-        agent_rows += f"""
+        agent_rows_parts.append(f"""
         <tr style="border-bottom:1px solid #e0e0e0;">
             <td style="padding: 10px; font-weight: bold;">{agent}</td>
-            <td style="padding: 10px; text-align: center;">{data['calls']}</td>
+            <td style="padding: 10px; text-align: center;">{calls}</td>
             <td style="padding: 10px; text-align: center; color: {a_color};">{a_anch}h</td>
             <td style="padding: 10px; text-align: center; color: {b_color};">{a_berth}h</td>
             <td style="padding: 10px; text-align: center; font-size: 12px;">{note}</td>
-        </tr>"""
-
-    vessel_rows = ""
-    for h in sorted(history, key=lambda x: x.get('departure', ''), reverse=True):
-        anch, berth = round(h.get('anchorage_hours', 0), 1), round(h.get('berth_hours', 0), 1)
-        vessel_rows += f"""
-        <tr style="border-bottom:1px solid #f0f0f0;">
-            <td style="padding: 8px; font-weight: bold;">{h['vessel']}</td>
-            <td style="padding: 8px;">{h.get('agent', '-')}</td>
-            <td style="padding: 8px; text-align: center;">{anch}h</td>
-            <td style="padding: 8px; text-align: center;">{berth}h</td>
-            <td style="padding: 8px; text-align: center; font-weight: bold;">{round(anch+berth, 1)}h</td>
-        </tr>"""
+        </tr>""")
+    agent_rows = "".join(agent_rows_parts)
 
     subject = f"📊 Rapport Mensuel BI : Port de {specific_port} ({total_calls} Escales)"
     body = f"""
@@ -289,22 +353,75 @@ def send_monthly_report(history: list, specific_port: str):
             </table>
         </div>
     </div>"""
-    send_email(EMAIL_TO, subject, body)
+    outbox.append((EMAIL_TO, subject, body))
     if specific_port == "Nador" and EMAIL_TO_COLLEAGUE: # Specific to monitor (3)
-        send_email(EMAIL_TO_COLLEAGUE, subject, body)
+        outbox.append((EMAIL_TO_COLLEAGUE, subject, body))
+
+def build_alert_outbox(alerts: Dict[str, list]) -> list:
+    """One consolidated email for all ports; the colleague keeps a Nador-only copy"""
+    parts, outbox = [_ALERT_INTRO_HTML], []
+    for p, vessels in alerts.items():
+        cards = "".join(format_vessel_details_premium(v) for v in vessels)
+        parts.append(_PORT_SECTION_TMPL.format(p=p))
+        parts.append(cards)
+        if p == "Nador" and EMAIL_TO_COLLEAGUE:
+            names = ", ".join([v.get('nOM_NAVIREField') or 'Unknown' for v in vessels])
+            outbox.append((EMAIL_TO_COLLEAGUE, f"🔔 ARRIVÉE {names} | {p}", _PORT_INTRO_TMPL.format(p=p) + cards))
+    total = sum(len(vessels) for vessels in alerts.values())
+    subject = f"🔔 NOUVELLE ARRIVÉE PRÉVUE | {total} navire(s) | {', '.join(alerts)}"
+    outbox.insert(0, (EMAIL_TO, subject, "".join(parts)))
+    return outbox
+
+class SMTPMailer:
+    """One SMTP session (STARTTLS + login) shared by every email of a run"""
+    def __init__(self):
+        self.server = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.server = None
+
+    def _connect(self):
+        self.server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=30)
+        self.server.starttls()
+        self.server.login(EMAIL_USER, EMAIL_PASS)
+
+    def _ensure_connected(self):
+        # Connect lazily, and reconnect if the server dropped us between sends
+        if self.server is None:
+            return self._connect()
+        try:
+            self.server.noop()
+        except smtplib.SMTPServerDisconnected:
+            self._connect()
 
-def send_email(to, sub, body):
-    if not EMAIL_ENABLED or not EMAIL_USER: return
-    msg = MIMEText(body, "html", "utf-8")
-    msg["Subject"], msg["From"], msg["To"] = sub, EMAIL_USER, to
-    try:
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=30) as server:
-            server.starttls()
-            server.login(EMAIL_USER, EMAIL_PASS)
-            server.sendmail(EMAIL_USER, [to], msg.as_string())
-        print(f"[SUCCESS] Email sent to {to}")
-    except Exception as e:
-        print(f"[ERROR] Email failed: {e}")
+    def send(self, to, sub, body):
+        msg = MIMEText(body, "html", "utf-8")
+        msg["Subject"], msg["From"], msg["To"] = sub, EMAIL_USER, to
+        try:
+            self._ensure_connected()
+            self.server.sendmail(EMAIL_USER, [to], msg.as_string())
+            print(f"[SUCCESS] Email sent to {to}")
+        except Exception as e:
+            print(f"[ERROR] Email failed: {e}")
+            self.close()
+
+def send_emails(outbox: list):
+    """Deliver queued (to, subject, body) tuples over a single SMTP session"""
+    if not outbox or not EMAIL_ENABLED or not EMAIL_USER: return
+    with SMTPMailer() as mailer:
+        for to, sub, body in outbox:
+            mailer.send(to, sub, body)
 
 # ==========================================
 # 🔄 MAIN PROCESS (BATTLE READY)
@@ -317,43 +434,60 @@ def main():
     active, history = state.get("active", {}), state.get("history", [])
 
     if RUN_MODE == "report":
+        outbox = []
         for p_code in ALLOWED_PORTS:
             p_name = port_name(p_code)
             p_hist = [h for h in history if h.get("port") == p_name]
-            if p_hist: send_monthly_report(p_hist, p_name)
+            if p_hist: send_monthly_report(p_hist, p_name, outbox)
+        send_emails(outbox)
         
-        # Archive and Cleanup
-        if os.path.exists(HISTORY_FILE):
-            try:
-                with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-                    old = json.load(f)
-                    if isinstance(old, list): history = old + history
-            except: pass
-        
-        with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-            json.dump(history, f, indent=2, ensure_ascii=False)
+        # Archive and Cleanup: only this month's records are appended, the archive is never rewritten
+        with open(HISTORY_FILE, "ab") as f:
+            f.write(b"".join(orjson.dumps(h, option=orjson.OPT_APPEND_NEWLINE) for h in history))
         
         state["history"] = []
         save_state(state)
         print("[LOG] Monthly reports and archiving completed.")
         return
 
+    # Bounded in-memory history: appends past the cap drop the oldest record
+    history = deque(history, maxlen=HISTORY_LIMIT)
+
     try:
-        all_data = fetch_vessel_data_with_retry()
+        all_data = fetch_vessel_data_with_retry(state)
     except Exception as e:
         print(f"[CRITICAL] API Failure: {e}")
         return
 
     now_utc = datetime.now(timezone.utc)
+    now_iso, now_ts = now_utc.isoformat(), int(now_utc.timestamp())
+
+    if all_data is None:
+        # Nothing changed upstream: timers catch up from last_updated on the next
+        # real payload, so only keep the active vessels from aging out
+        for stored in active.values():
+            stored["last_seen"] = now_iso
+            stored["last_seen_ts"] = now_ts
+        save_state(state)
+        print(f"[STATS] Tracking {len(active)} vessels | History: {len(history)}")
+        return
     live_vessels = {}
     
+    # Hottest loop of the run: most API rows belong to other ports, so keep
+    # the rejection path to a local lookup and skip str() when already a str
+    allowed = ALLOWED_PORTS
     for e in all_data:
-        port_code = str(e.get("cODE_SOCIETEField", ""))
-        if port_code in ALLOWED_PORTS:
+        port_code = e.get("cODE_SOCIETEField")
+        if port_code is None: continue
+        if not isinstance(port_code, str): port_code = str(port_code)
+        if port_code in allowed:
             # FIXED: Sanitize status
-            status = clean_status(e.get("sITUATIONField"))
-            v_id = f"{e.get('nUMERO_LLOYDField','0')}-{e.get('nUMERO_ESCALEField','0')}"
+            get = e.get
+            status = clean_status(get("sITUATIONField"))
+            v_id = f"{get('nUMERO_LLOYDField','0')}-{get('nUMERO_ESCALEField','0')}"
             live_vessels[v_id] = {"e": e, "status": status}
+    # Rows for other ports are no longer needed; free them before tracking and email
+    del all_data
 
     alerts, to_remove = {}, []
     
@@ -364,20 +498,21 @@ def main():
         live = live_vessels.get(v_id)
         if live:
             # 1. Update timers based on time elapsed since last check
-            stored = update_vessel_timers(stored, live["status"], now_utc)
+            stored = update_vessel_timers(stored, live["status"], now_utc, now_iso, now_ts)
             
             # 2. Universal Completion Logic
             # Triggers history for ANY ship entering a completed state (APPAREILLAGE/TERMINE)
             # regardless of whether it was at Quai or Anchorage previously.
             if live["status"] in COMPLETED_STATUSES:
+                entry = stored["entry"]
                 history.append({
-                    "vessel": stored["entry"].get('nOM_NAVIREField', 'Unknown'),
-                    "agent": stored["entry"].get("cONSIGNATAIREField", "Inconnu"),
-                    "port": port_name(stored["entry"].get('cODE_SOCIETEField')),
+                    "vessel": entry.get('nOM_NAVIREField', 'Unknown'),
+                    "agent": entry.get("cONSIGNATAIREField", "Inconnu"),
+                    "port": port_name(entry.get('cODE_SOCIETEField')),
                     "anchorage_hours": round(stored.get("anchorage_hours", 0.0), 1),
                     "berth_hours": round(stored.get("berth_hours", 0.0), 1),
-                    "arrival": stored.get("first_seen", now_utc.isoformat()),
-                    "departure": now_utc.isoformat()
+                    "arrival": stored.get("first_seen", now_iso),
+                    "departure": now_iso
                 })
                 to_remove.append(v_id)
             
@@ -387,7 +522,8 @@ def main():
             # If vessel disappears from API, DO NOT update timers (prevents time inflation).
             # Only update last_seen to keep it in state for a few hours in case of API glitches.
             # Eventually the cleanup logic (below) will remove it after 3 days.
-            stored["last_seen"] = now_utc.isoformat()
+            stored["last_seen"] = now_iso
+            stored["last_seen_ts"] = now_ts
     
     # Remove ships that have completed their cycle
     for vid in to_remove: active.pop(vid, None)
@@ -403,24 +539,38 @@ def main():
             active[v_id] = {
                 "entry": live["e"], "current_status": live["status"],
                 "anchorage_hours": 0.0, "berth_hours": 0.0,
-                "first_seen": now_utc.isoformat(), "last_updated": now_utc.isoformat(), "last_seen": now_utc.isoformat()
+                "first_seen": now_iso, "last_updated": now_iso, "last_seen": now_iso,
+                "last_seen_ts": now_ts
             }
             if live["status"] in PLANNED_STATUSES:
                 p = port_name(live['e'].get("cODE_SOCIETEField"))
                 alerts.setdefault(p, []).append(live["e"])
 
     # Final Cleanup and Save
-    cutoff = now_utc - timedelta(days=3)
-    state["active"] = {k: v for k, v in active.items() if datetime.fromisoformat(v.get("last_seen", now_utc.isoformat())).replace(tzinfo=timezone.utc) > cutoff}
-    state["history"] = history[-1000:]
-    save_state(state)
-
-    if alerts:
-        for p, vessels in alerts.items():
-            names = ", ".join([v.get('nOM_NAVIREField', 'Unknown') for v in vessels])
-            body = f"<p>Bonjour,<br>Mouvements prévus au Port de <b>{p}</b> :</p>" + "".join([format_vessel_details_premium(v) for v in vessels])
-            send_email(EMAIL_TO, f"🔔 NOUVELLE ARRIVÉE | {names} au Port de {p}", body)
-            if p == "Nador" and EMAIL_TO_COLLEAGUE: send_email(EMAIL_TO_COLLEAGUE, f"🔔 ARRIVÉE {names} | {p}", body)
+    # GC compares integer epochs; entries saved before last_seen_ts existed are migrated once
+    cutoff_ts = int((now_utc - timedelta(days=3)).timestamp())
+    for v in active.values():
+        if "last_seen_ts" not in v:
+            last_seen = v.get("last_seen")
+            v["last_seen_ts"] = int(_parse_iso(last_seen).timestamp()) if last_seen else now_ts
+    state["active"] = {k: v for k, v in active.items() if v["last_seen_ts"] > cutoff_ts}
+    state["history"] = list(history)
+
+    outbox = []
+    if alerts and not (EMAIL_ENABLED and EMAIL_USER):
+        print(f"[LOG] Email disabled, skipping {sum(len(v) for v in alerts.values())} alerts")
+    elif alerts:
+        # Guarded so a malformed entry can never skip the state save below
+        try:
+            outbox = build_alert_outbox(alerts)
+        except Exception as e:
+            print(f"[ERROR] Alert email build failed: {e}")
+    
+    # SMTP delivery is network-bound: run it while the state file is written
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        delivery = pool.submit(send_emails, outbox)
+        save_state(state)
+        delivery.result()
     
     print(f"[STATS] Tracking {len(state['active'])} vessels | History: {len(history)}")
 